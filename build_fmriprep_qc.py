@@ -17,12 +17,24 @@ Optional:
 
 
 import os
+import collections
+import functools
 import bids
 from docopt import docopt
-import re
+from concurrent.futures import ThreadPoolExecutor
 
 
 FIGSPERPAGE=20
+MAXWORKERS=16
+
+@functools.lru_cache(maxsize=8192)
+def _relpath(path,start):
+    '''
+    Memoized os.path.relpath; the same (path, start) pairs recur across
+    tasks and modalities
+    '''
+
+    return os.path.relpath(path,start)
 
 def filter_ignored_fields(filelist, ignore_fields):
     '''
@@ -35,23 +47,23 @@ def filter_ignored_fields(filelist, ignore_fields):
     if not ignore_fields:
         return set(filelist)
 
-    #For each field to remove, go through list and remove
-    new_list = []
-    for i in ignore_fields:
+    #BIDS names are strictly key-value_key-value, so drop fields by splitting
+    #on underscores rather than regex scanning
+    ignore = set(ignore_fields)
+    new_list = set()
+    for f in filelist:
+        parts = [p for p in f.split('_') if p.split('-',1)[0] not in ignore]
+        new_list.add('_'.join(parts))
 
-        #Set up regex to look for substring match
-        pattern = re.compile("{}-.*?(?=_)".format(i))
+    return new_list
 
-        for f in filelist:
-
-            try:
-                match = pattern.findall(f)[0]
-            except IndexError:
-                new_list.append(f)
-
-            new_list.append( f.replace('_{}'.format(match),'') )
+def strip_nii_ext(filename):
+    '''
+    Remove a literal .nii.gz suffix
+    (str.strip('.nii.gz') strips any of those characters from both ends)
+    '''
 
-    return set(new_list)
+    return filename[:-7] if filename.endswith('.nii.gz') else filename
 
 def participants_tsv(layout,output,ignore_fields):
     '''
@@ -64,7 +76,7 @@ def participants_tsv(layout,output,ignore_fields):
 
     #Get all BOLD files and remove extension
     f = layout.get(extension='nii.gz',space='T1w',suffix='bold')
-    f = list(set(['_'.join(x.filename.strip('.nii.gz').split('_')[1:]) for x in f]))
+    f = list(set(['_'.join(strip_nii_ext(x.filename).split('_')[1:]) for x in f]))
     f = filter_ignored_fields(f,ignore_fields)
 
     #Make participants.tsv file!
@@ -87,10 +99,8 @@ def add_image_row(tag,svg):
     Insert HTML markup for inserting image with tag
     '''
 
-    return ''' 
-    <tr><td>{}</td></tr> 
-    <tr><td><object type="image/svg+xml" data="{}"></object></td></tr>
-    '''.format(tag,svg)
+    return (f'<tr><td>{tag}</td></tr>'
+            f'<tr><td><object type="image/svg+xml" data="{svg}"></object></td></tr>')
 
 
 def make_anatomical_qc(layout,output):
@@ -100,18 +110,55 @@ def make_anatomical_qc(layout,output):
 
     #Get list of subjects and fmriprep dir
     fmriprep_dir = layout.root
-    subjects = [s for s in layout.get_subjects() if 
-            os.path.exists(os.path.join(fmriprep_dir,'sub-'+s,'figures'))]
+    subjects = filter_subjects(fmriprep_dir,layout.get_subjects())
+
+    #List each subject's figures directory once up front
+    figs_cache = list_figures(fmriprep_dir,subjects)
+
+    #Subjects without a figures directory have nothing to QC
+    subjects = [s for s in subjects if s in figs_cache]
 
     #Brainmask
     brainmask_dir = os.path.join(output,'brainmask')
     makedir(brainmask_dir)
-    gen_anatomical_qc(fmriprep_dir,subjects,'_seg_brainmask',brainmask_dir)
+    gen_anatomical_qc(fmriprep_dir,subjects,figs_cache,'_seg_brainmask',brainmask_dir)
 
     #T12MNI
     t12mni_dir = os.path.join(output,'t12mni')
     makedir(t12mni_dir)
-    gen_anatomical_qc(fmriprep_dir,subjects,'t1_2_mni',t12mni_dir)
+    gen_anatomical_qc(fmriprep_dir,subjects,figs_cache,'t1_2_mni',t12mni_dir)
+
+def filter_subjects(root_dir,subjects):
+    '''
+    Keep subjects with an output directory under the derivatives root,
+    using a single listing of the root instead of one stat per subject
+    '''
+
+    existing = {e.name for e in os.scandir(root_dir)
+            if e.is_dir(follow_symlinks=False)}
+
+    return [s for s in subjects if 'sub-'+s in existing]
+
+def list_figures(root_dir,subjects):
+    '''
+    Scan each subject's figures directory exactly once and cache the
+    SVG names, avoiding a directory listing per task/modality
+
+    Scans are spread over a thread pool so that per-directory latency
+    overlaps on network filesystems; subjects without a figures
+    directory are dropped from the cache
+    '''
+
+    def scan(s):
+        try:
+            return tuple(e.name for e in
+                os.scandir(os.path.join(root_dir,'sub-'+s,'figures')))
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=MAXWORKERS) as pool:
+        return {s: svgs for s,svgs in zip(subjects, pool.map(scan,subjects))
+                if svgs is not None}
 
 def makedir(path):
     try:
@@ -121,19 +168,21 @@ def makedir(path):
     return
 
 
-def gen_anatomical_qc(root_dir,subjects,keyword,output):
+def gen_anatomical_qc(root_dir,subjects,figs_cache,keyword,output):
     '''
-    Given a root directory, subjects, a keyword and output filename
+    Given a root directory, subjects, a cache of figure names, a keyword and output filename
     Make an anatomical QC page
     '''
 
-    html = []
+    #Figure paths always sit at root_dir/sub-X/figures, so resolve the
+    #relative prefix once rather than calling relpath per subject
+    rel_prefix = _relpath(root_dir, output)
+
+    rows = []
     missing_svg = []
-    page_num = 0
-    for i,s in enumerate(subjects):
+    for s in subjects:
 
-        figdir = os.path.join(root_dir,'sub-' + s, 'figures')
-        svgs = os.listdir(figdir)
+        svgs = figs_cache[s]
 
         #Search for relevant SVG
         try:
@@ -142,123 +191,119 @@ def gen_anatomical_qc(root_dir,subjects,keyword,output):
             missing_svg.append(s)
             continue
 
-        #Now build paginated QC page, link to next one if available
-        if ((i != 0) and (i % FIGSPERPAGE == 0)) or (i == len(subjects)-1):
-
-            page = os.path.join(output,'{}.html'.format(page_num))
-
-            #Handle previous and next page
-            prev_pg = ''
-            nxt_pg = ''
-
-            #If a page can still be fit, then add next page button
-            if i + FIGSPERPAGE <= len(subjects):
-                nxt_pg = '<td><a href="./{}.html">Next Page</a></td>'.format(page_num+1)
-
-            #If at least one page is already done, then add a previous page button
-            if i - FIGSPERPAGE > 0:
-                prev_pg = '<td><a href="./{}.html">Previous Page</a></td>'.format(page_num-1)
-            footer = '<tr>{}{}</tr>'.format(prev_pg,nxt_pg)
-            html.append(footer)
-
-            #Write, increment page
-            with open(page,'w') as f:
-                f.writelines(html)
-            html = []
-            page_num += 1
-
-        #Get full path to SVG file, make relative to page
-        svg = os.path.join(figdir,svg)
-        rel_svg = os.path.relpath(svg, output)
+        #Get path to SVG file relative to page
+        rows.append( (s, os.path.join(rel_prefix,'sub-' + s,'figures',svg)) )
 
-        #Append to HTML
-        html.append(add_image_row(s, rel_svg))
+    write_paged_html(rows, output)
 
     return
 
-def make_fc_html(svg_tups, output):
+def write_paged_html(svg_tups, output):
     '''
-    Given a list of tuples mapping task files names to their svg counterparts,
-    construct an html file
+    Given a list of tuples mapping tags to their page-relative svg paths,
+    stream numbered pages of FIGSPERPAGE figures each, linked to one another
+
+    Rows are written as they arrive instead of buffered per page, so memory
+    stays flat regardless of FIGSPERPAGE
     '''
-    html = []
+
+    fh = None
     page_num = 0
-    
+
     for i,t in enumerate(svg_tups):
 
-        #Split tup to filename tag and svg
-        filename,svg = t
+        #Split tup to tag and svg
+        tag,svg = t
+
+        #Open the next page lazily so no empty trailing page is created
+        if fh is None:
+            fh = open(os.path.join(output,'{}.html'.format(page_num)),'w',
+                    buffering=1<<16)
 
-        #Now build paginated QC page, link to next one if available
-        if ((i != 0) and (i % FIGSPERPAGE == 0)) or (i == len(svg_tups)-1):
+        fh.write(add_image_row(tag, svg))
 
-            page = os.path.join(output,'{}.html'.format(page_num))
+        #Close out the page once full or after the final row
+        if ((i+1) % FIGSPERPAGE == 0) or (i == len(svg_tups)-1):
 
             #Handle previous and next page
             prev_pg = ''
             nxt_pg = ''
 
-            #If a page can still be fit, then add next page button
-            if i + FIGSPERPAGE <= len(svg_tups):
+            #If rows remain, then another page follows this one
+            if i != len(svg_tups)-1:
                 nxt_pg = '<td><a href="./{}.html">Next Page</a></td>'.format(page_num+1)
 
             #If at least one page is already done, then add a previous page button
-            if i - FIGSPERPAGE > 0:
+            if page_num > 0:
                 prev_pg = '<td><a href="./{}.html">Previous Page</a></td>'.format(page_num-1)
-            footer = '<tr>{}{}</tr>'.format(prev_pg,nxt_pg)
-            html.append(footer)
 
-            #Write, increment page
-            with open(page,'w') as f:
-                f.writelines(html)
-            html = []
+            fh.write('<tr>{}{}</tr>'.format(prev_pg,nxt_pg))
+            fh.close()
+            fh = None
             page_num += 1
 
-        #Get full path to SVG file, make relative to page
-        rel_svg = os.path.relpath(svg, output)
-
-        #Append to HTML
-        html.append(add_image_row(filename, rel_svg))
-
     return
 
-def get_func_svg(sub,ses,task,run,figtype,flist,exclude=[]):
+def index_figures(figs_cache):
     '''
-    Pull svg for specific task, run and figure type from a list of figures in fmriprep derivatives
+    Build a per-subject reverse index mapping each underscore-delimited token
+    of an svg name to the set of svg names containing it, so figure lookups
+    become set intersections instead of scans over the full listing
     '''
 
-    exclude = set(exclude)
+    index = {}
+    for s,svgs in figs_cache.items():
 
-    for f in flist:
-        splitted = f.split('.')[0].split('_')
+        tokens = {}
+        for name in svgs:
+            for tok in name.split('.')[0].split('_'):
+                tokens.setdefault(tok,set()).add(name)
+        index[s] = tokens
 
+    return index
 
-        #Checks
-        sub_in = ('sub-'+sub) in splitted
-        ses_in = ('ses-'+str(ses)) in splitted
-        task_in = ('task-'+task) in splitted
+def get_entity_matches(sub,ses,task,run,fig_index):
+    '''
+    Intersect the subject/session/task/run token sets of a subject's index,
+    building the entity tokens once per task file instead of per keyword
+    '''
 
-        if run:
-            run_in = (('run-'+str(run)) in splitted) or (('run-0'+str(run)) in splitted)
-        else:
-            run_in = True
+    empty = set()
+    matches = ( fig_index.get('sub-'+sub,empty)
+              & fig_index.get('ses-'+str(ses),empty)
+              & fig_index.get('task-'+task,empty) )
+
+    if run:
+        matches = matches & ( fig_index.get('run-'+str(run),empty)
+                            | fig_index.get('run-0'+str(run),empty) )
+
+    return matches
 
-        figtype_in = figtype in splitted
+def get_func_svg(entity_matches,figtype,fig_index,exclude=[]):
+    '''
+    Narrow a precomputed entity match set down to a specific figure type
+    '''
 
-        #For exclusions to set-based intersection
-        exclude_in = exclude.intersection(set(splitted))
+    empty = set()
+    matches = entity_matches & fig_index.get(figtype,empty)
 
-        if sub_in and ses_in and task_in and run_in and figtype_in:
+    #Drop any svg carrying an excluded token
+    for e in exclude:
+        matches = matches - fig_index.get(e,empty)
 
-            if len(exclude_in) == 0:
-                return f
+    if matches:
+        return min(matches)
 
-def gen_functional_qc(root_dir,taskfiles,task,keywords,output,exclusions=[]):
+def gen_functional_qc(root_dir,taskfiles,task,keywords,figs_index,output,exclusions=[]):
     '''
-    Given the fmriprep derivatives root dir, subjects, task and keywords
+    Given the fmriprep derivatives root dir, task files, task, keywords and a token index of figure names
     Generate html qc pages in a hierarchical structure
     '''
 
+    #Figure paths always sit at root_dir/sub-X/figures, so resolve the
+    #relative prefix once rather than calling relpath per task file
+    rel_prefix = _relpath(root_dir, output)
+
     missing_svg = []
     map_tuples = []
 
@@ -272,11 +317,14 @@ def gen_functional_qc(root_dir,taskfiles,task,keywords,output,exclusions=[]):
         except KeyError:
             run = False
 
-        figdir = os.path.join(root_dir,'sub-' + sub, 'figures')
-        svgs = os.listdir(figdir)
+        fig_index = figs_index.get(sub,{})
+
+        #Entity tokens are fixed per task file; resolve them once, then
+        #narrow per keyword
+        entity_matches = get_entity_matches(sub,ses,task,run,fig_index)
 
         try:
-            svg = [get_func_svg(sub,ses,task,run,k,svgs,exclusions) for k in keywords][0]
+            svg = [get_func_svg(entity_matches,k,fig_index,exclusions) for k in keywords][0]
         except IndexError:
             missing_svg.append(f)
             continue
@@ -285,12 +333,12 @@ def gen_functional_qc(root_dir,taskfiles,task,keywords,output,exclusions=[]):
                 missing_svg.append(f)
                 continue
 
-        map_tuples.append( (f.filename, os.path.join(figdir,svg)) )
+        map_tuples.append( (f.filename, os.path.join(rel_prefix,'sub-' + sub,'figures',svg)) )
 
     if len(missing_svg) == len(taskfiles):
         return
     else:
-        make_fc_html(map_tuples, output)
+        write_paged_html(map_tuples, output)
 
 def make_functional_qc(layout,output, space):
     '''
@@ -299,38 +347,42 @@ def make_functional_qc(layout,output, space):
 
     #For each task there are 3 modalities to make
     fmriprep_dir = layout.root
-    subjects = [s for s in layout.get_subjects() if
-            os.path.exists(os.path.join(fmriprep_dir,'sub-'+s,'figures'))]
-    
-    for t in layout.get_tasks():
+    subjects = filter_subjects(fmriprep_dir,layout.get_subjects())
+
+    #List each subject's figures directory once up front and index by token
+    figs_index = index_figures(list_figures(fmriprep_dir,subjects))
+
+    #Query the layout once and group by task, rather than one query per task
+    by_task = collections.defaultdict(list)
+    for f in layout.get(suffix='bold',space=space,extension='.nii.gz'):
+        by_task[f.entities['task']].append(f)
 
-        taskfiles = layout.get(task=t,suffix='bold',space=space,extension='.nii.gz')
+    for t,taskfiles in by_task.items():
 
         #EPI-TO-T1
         epi2t1_dir = os.path.join(output,t,'epi2t1')
         makedir(epi2t1_dir)
-        gen_functional_qc(fmriprep_dir,taskfiles,t,['bbregister','coreg'],epi2t1_dir)
+        gen_functional_qc(fmriprep_dir,taskfiles,t,['bbregister','coreg'],figs_index,epi2t1_dir)
 
         #SDC
         sdc_dir = os.path.join(output,t,'sdc')
         makedir(sdc_dir)
-        gen_functional_qc(fmriprep_dir,taskfiles,t,['sdc'],sdc_dir)
+        gen_functional_qc(fmriprep_dir,taskfiles,t,['sdc'],figs_index,sdc_dir)
 
         #ROIS
         roi_dir = os.path.join(output,t,'rois')
         makedir(roi_dir)
-        gen_functional_qc(fmriprep_dir,taskfiles,t,['rois'],roi_dir)
+        gen_functional_qc(fmriprep_dir,taskfiles,t,['rois'],figs_index,roi_dir)
 
         #FIELDMAPS MASK
-        import pdb; pdb.set_trace()
         fieldmask_dir = os.path.join(output,t,'fieldmaps_mask')
         makedir(fieldmask_dir)
-        gen_functional_qc(fmriprep_dir,taskfiles,t,['mask'],fieldmask_dir)
+        gen_functional_qc(fmriprep_dir,taskfiles,t,['mask'],figs_index,fieldmask_dir)
 
         #FIELDMAPS REG
         fieldreg_dir = os.path.join(output,t,'fieldmaps_reg')
         makedir(fieldreg_dir)
-        gen_functional_qc(fmriprep_dir,taskfiles,t,['fmap'],fieldreg_dir,exclusions=['vsm','mask'])
+        gen_functional_qc(fmriprep_dir,taskfiles,t,['fmap'],figs_index,fieldreg_dir,exclusions=['vsm','mask'])
 
     return
 
@@ -342,7 +394,13 @@ def main():
     ignore_fields   =   args['--ignore']
     space           =   args['--space'] or 'T1w'
 
-    layout = bids.BIDSLayout(fmriprep_dir,derivatives=True,validate=False)
+    #Persist the index next to the QC output so reruns skip reindexing
+    #Skip JSON sidecar parsing entirely; QC only needs filenames and entities
+    indexer = bids.BIDSLayoutIndexer(validate=False,index_metadata=False)
+    layout = bids.BIDSLayout(fmriprep_dir,derivatives=True,validate=False,
+            indexer=indexer,
+            database_path=os.path.join(output_dir,'.pybids_db'),
+            reset_database=False)
 
     #Generate participants.tsv template
     participants_tsv(layout,output_dir,ignore_fields)
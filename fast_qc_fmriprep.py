@@ -16,9 +16,28 @@ Optional:
 '''
 
 import os
+import collections
 import bids
 from docopt import docopt
 import re
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+MAXWORKERS=16
+
+@functools.lru_cache(maxsize=8192)
+def _relpath(path,start):
+    '''
+    Memoized os.path.relpath; the same (path, start) pairs recur across pages
+    '''
+
+    return os.path.relpath(path,start)
+
+#Matches the BIDS base specification of a filename (everything before _space)
+_BIDSBASE_RE = re.compile('.*?(?=_space)')
+
+#Page name and the list of HTML fragments making up a task QC page
+TaskHtml = collections.namedtuple('TaskHtml','name lines')
 
 def filter_ignored_fields(filelist, ignore_fields):
     '''
@@ -31,57 +50,71 @@ def filter_ignored_fields(filelist, ignore_fields):
     if not ignore_fields:
         return set(filelist)
 
-    #For each field to remove, go through list and remove
-    new_list = []
-    for i in ignore_fields:
+    #BIDS names are strictly key-value_key-value, so drop fields by splitting
+    #on underscores rather than regex scanning
+    ignore = set(ignore_fields)
+    new_list = set()
+    for f in filelist:
+        parts = [p for p in f.split('_') if p.split('-',1)[0] not in ignore]
+        new_list.add('_'.join(parts))
 
-        #Set up regex to look for substring match
-        pattern = re.compile("{}-.*?(?=_)".format(i))
+    return new_list
 
-        for f in filelist:
+def list_figures(root_dir,subjects):
+    '''
+    Scan each subject's figures directory exactly once and cache the
+    SVG names for reuse across the QC pages
 
-            try:
-                match = pattern.findall(f)[0]
-            except IndexError:
-                new_list.append(f)
+    Scans are spread over a thread pool so that per-directory latency
+    overlaps on network filesystems
+    '''
 
-            new_list.append( f.replace('_{}'.format(match),'') )
+    def scan(s):
+        return tuple(e.name for e in
+            os.scandir(os.path.join(root_dir,'sub-{}'.format(s),'figures')))
 
-    return set(new_list)
+    with ThreadPoolExecutor(max_workers=MAXWORKERS) as pool:
+        return dict(zip(subjects, pool.map(scan,subjects)))
 
-def detect_fieldmaps(fmriprep_dir,subjects):
+def detect_fieldmaps(figs_cache):
     '''
     Checks if key fieldmaps svg exists within any one subject directory
     '''
 
-    #Loop through subject output directories
-    for s in subjects:
-        fig_dir = os.path.join(fmriprep_dir,'sub-{}'.format(s),'figures')
-        svgs = os.listdir(fig_dir)
-
-        if any([True if 'fmap_mask' in f else False for f in svgs]):
+    #Reuse the cached listings and stop at the first hit
+    for svgs in figs_cache.values():
+        if any('fmap_mask' in f for f in svgs):
             return True
 
     #If not a single subject has a fmap_mask svg file, then fmaps don't exist
     return False
-    
 
-def participants_tsv(layout,output,ignore_fields):
+
+def strip_nii_ext(filename):
+    '''
+    Remove a literal .nii.gz suffix
+    (str.strip('.nii.gz') strips any of those characters from both ends)
+    '''
+
+    return filename[:-7] if filename.endswith('.nii.gz') else filename
+
+def participants_tsv(layout,output,ignore_fields,figs_cache):
     '''
     Generate a template for participants.tsv by scraping the output file types
-    
+
     layout                          BIDSLayout object
     output                          Directory to output into
     ignore_fields                   List of fields to ignore when generating the columns of participants.tsv
+    figs_cache                      Cached figure listings keyed by subject
     '''
 
     #Get all BOLD files and remove extension
     f = layout.get(extension='nii.gz',space='T1w',suffix='bold')
-    f = list(set(['_'.join(x.filename.strip('.nii.gz').split('_')[1:]) for x in f]))
+    f = list(set(['_'.join(strip_nii_ext(x.filename).split('_')[1:]) for x in f]))
     f = filter_ignored_fields(f,ignore_fields)
 
-    #Check if fmaps exist 
-    fmap_exists = detect_fieldmaps(layout.root, layout.get_subjects()) 
+    #Check if fmaps exist
+    fmap_exists = detect_fieldmaps(figs_cache)
     fmap_col = ['fmap_mask'] if fmap_exists else []
 
     #Make participants.tsv file!
@@ -129,12 +162,9 @@ def get_svg_markup(svg):
     Generate an HTML snippet that inserts an svg image
     '''
 
-    template = '''
-    <tr><td><object type="image/svg+xml" data="{}"></object></td></tr>
-    '''
-    return template.format(svg)
+    return f'<tr><td><object type="image/svg+xml" data="{svg}"></object></td></tr>'
 
-def make_broad_html(sub, sub_figs, sub_files, output, fig_dir):
+def make_broad_html(sub, sub_figs, sub_files, output, rel_figdir):
     '''
     Generate HTML code for broad QC (exclusion here should invalidate all scans)
     '''
@@ -143,10 +173,9 @@ def make_broad_html(sub, sub_figs, sub_files, output, fig_dir):
     html += ['{}\n'.format('sub-'+sub)]
 
     svgs,desc = get_broad_qc(sub_figs)
-    svgs = [os.path.join(fig_dir,s) for s in svgs]
 
     desc_markup = ['<tr><td>{}</td></tr>'.format(d) for d in desc]
-    html += [d + get_svg_markup(os.path.relpath(f,output)) for f,d in zip(svgs,desc)]
+    html += [d + get_svg_markup(os.path.join(rel_figdir,f)) for f,d in zip(svgs,desc)]
 
 
 
@@ -164,7 +193,7 @@ def get_task_ordering_key(bidsfile):
 
     return (task,run)
 
-def make_task_html(sub,output,fig_dir,sub_figs,task_file):
+def make_task_html(sub,output,rel_figdir,sub_figs,task_file):
     '''
     Generate HTML code for taskfile QC
     '''
@@ -179,50 +208,48 @@ def make_task_html(sub,output,fig_dir,sub_figs,task_file):
     # 3: EPI --> T1 
 
     #Get BIDS base specification
-    pattern = re.compile('.*?(?=_space)')
     try:
-        bidsbase = pattern.findall(task_file.filename)[0]
+        bidsbase = _BIDSBASE_RE.findall(task_file.filename)[0]
     except IndexError:
         return
 
-    #With this we can now filter the sub_figs to those of interest
-    task_figs = [f for f in sub_figs if bidsbase in f]
+    #Bucket the first svg of each figure type in a single pass over sub_figs
+    fmap_svg = sdc_svg = epi2t1_svg = None
+    for f in sub_figs:
+
+        if bidsbase not in f:
+            continue
+
+        if fmap_svg is None and 'fmap_reg.svg' in f:
+            fmap_svg = f
+        if sdc_svg is None and 'sdc' in f:
+            sdc_svg = f
+        if epi2t1_svg is None and (('bbregister' in f) or ('coreg' in f)):
+            epi2t1_svg = f
+
+        if fmap_svg and sdc_svg and epi2t1_svg:
+            break
 
     #Pull fmap if available and add to HTML
-    try:
-        fmap_svg = [s for s in task_figs if 'fmap_reg.svg' in s][0]
-    except IndexError:
-        pass
-    else:
-        fmap_svg = os.path.relpath(os.path.join(fig_dir,fmap_svg), output)
-        html += [get_svg_markup(fmap_svg)]
+    if fmap_svg is not None:
+        html += [get_svg_markup(os.path.join(rel_figdir,fmap_svg))]
 
     #Now do SDC if available
-    try:
-        sdc_svg = [s for s in task_figs if 'sdc' in s][0]
-    except IndexError:
-        pass
-    else:
-        sdc_svg = os.path.relpath(os.path.join(fig_dir,sdc_svg), output)
-        html += [get_svg_markup(sdc_svg)]
+    if sdc_svg is not None:
+        html += [get_svg_markup(os.path.join(rel_figdir,sdc_svg))]
 
     #Finally do epi-->T1
-    try:
-        epi2t1_svg = [s for s in task_figs if ('bbregister' in s) or ('coreg' in s)][0]
-    except IndexError:
-        pass
-    else:
-        epi2t1_svg = os.path.relpath(os.path.join(fig_dir,epi2t1_svg), output)
-        html += [get_svg_markup(epi2t1_svg)]
+    if epi2t1_svg is not None:
+        html += [get_svg_markup(os.path.join(rel_figdir,epi2t1_svg))]
 
-    return [bidsbase + '.html', html]
+    return TaskHtml(bidsbase + '.html', html)
 
 def add_link(pg,text):
     '''
     Return markup for adding a page
     '''
 
-    return '<td><a href="./{}">{}</a></td>'.format(pg,text)
+    return f'<td><a href="./{pg}">{text}</a></td>'
 
 
 def main():
@@ -233,14 +260,35 @@ def main():
     output_dir      =   args['<output_dir>']
     ignore_fields   =   args['--ignore']
 
-    layout = bids.BIDSLayout(fmriprep_dir,validate=False, index_metadata=False)
+    #Persist the index next to the QC output so reruns skip reindexing
+    #Skip JSON sidecar parsing entirely; QC only needs filenames and entities
+    indexer = bids.BIDSLayoutIndexer(validate=False,index_metadata=False)
+    layout = bids.BIDSLayout(fmriprep_dir,validate=False,indexer=indexer,
+            database_path=os.path.join(output_dir,'.pybids_db'),
+            reset_database=False)
+
+    #List each subject's figures directory once up front
+    subjects = layout.get_subjects()
+    figs_cache = list_figures(layout.root,subjects)
 
     # Generate participants.tsv template
-    participants_tsv(layout,output_dir,ignore_fields)
+    participants_tsv(layout,output_dir,ignore_fields,figs_cache)
 
     #Now loop through each participant's scans and start building QC pages
     html_series = []
-    subjects = layout.get_subjects()
+
+    #Query the layout once and group by subject, rather than one query per subject
+    files_by_sub = collections.defaultdict(list)
+    for f in layout.get(extension='nii.gz'):
+        files_by_sub[f.entities['subject']].append(f)
+
+    bold_by_sub = collections.defaultdict(list)
+    for f in layout.get(extension='nii.gz',suffix='bold',space='T1w'):
+        bold_by_sub[f.entities['subject']].append(f)
+
+    #Relative prefix from the output pages back into the derivatives tree
+    rel_root = _relpath(layout.root, output_dir)
+
     no_task = []
     prev_task_htmls = [] 
     for ind,s in enumerate(subjects):
@@ -248,54 +296,61 @@ def main():
         broad_name = 'sub-{}_{}.html'.format(s,ind)
 
         #Get relevant files for subject
-        fig_dir = os.path.join(layout.root,'sub-{}'.format(s),'figures')
-        sub_figs = os.listdir(fig_dir)
-        sub_files = layout.get(subject=s,extension='nii.gz')
+        #Figure paths always sit at root/sub-X/figures, so resolve the
+        #relative prefix once per subject rather than relpath per svg
+        rel_figdir = os.path.join(rel_root,'sub-{}'.format(s),'figures')
+        sub_figs = figs_cache[s]
+        sub_files = files_by_sub.get(s,[])
 
         #Get broad QC markup
-        broad_html = make_broad_html(s, sub_figs, sub_files, output_dir, fig_dir)
+        broad_html = make_broad_html(s, sub_figs, sub_files, output_dir, rel_figdir)
 
         #Write in link to the previous task html
         if ind > 0:
-            broad_html += [add_link(prev_task_htmls[-1][0],'Previous Page')]
+            broad_html += [add_link(prev_task_htmls[-1].name,'Previous Page')]
 
         #Get functional markup (one per taskfile)
-        task_files = layout.get(subject=s,extension='nii.gz',suffix='bold',space='T1w')
-        task_files = sorted(task_files,key = lambda x: get_task_ordering_key(x))
-        task_htmls = [make_task_html(s,output_dir,fig_dir,sub_figs,t) for t in task_files]
+        #Decorate with the ordering key up front so each file's entities dict
+        #is materialized exactly once, then sort and strip the decoration
+        decorated = [(get_task_ordering_key(t),i,t) for i,t in enumerate(bold_by_sub.get(s,[]))]
+        decorated.sort()
+        task_files = [d[2] for d in decorated]
+        #Drop files whose name carries no BIDS base (make_task_html returns None)
+        task_htmls = [make_task_html(s,output_dir,rel_figdir,sub_figs,t) for t in task_files]
+        task_htmls = [t for t in task_htmls if t is not None]
 
         #Step 1: Write the first task_html name into broad_html
         try:
-            broad_html += [add_link(task_htmls[0][0], 'Next Page')]
+            broad_html += [add_link(task_htmls[0].name, 'Next Page')]
         except IndexError:
             no_task.append(s)
             continue
 
         #Step 2: Link broad html to first task_html
-        task_htmls[0][1] += [add_link(broad_name,'Previous Page')]
+        task_htmls[0].lines.append(add_link(broad_name,'Previous Page'))
 
         #Step 3: Link each task HTML to the previous
         for i in range(1,len(task_htmls)):
-            task_htmls[i][1] += [add_link(task_htmls[i-1][0], 'Previous Page')]
+            task_htmls[i].lines.append(add_link(task_htmls[i-1].name, 'Previous Page'))
 
         #Step 4: Link each task HTML to the next
         for i in range(0,len(task_htmls) - 1):
-            task_htmls[i][1] += [add_link(task_htmls[i+1][0], 'Next Page')]
+            task_htmls[i].lines.append(add_link(task_htmls[i+1].name, 'Next Page'))
 
         #Step 5: Link broad_html to the next subject
         if ind != len(subjects) - 1:
             broad_html += [add_link('sub-{}_{}.html'.format(subjects[ind+1],ind+1),'Next Subject')]
-            task_htmls[-1][1] += [add_link('sub-{}_{}.html'.format(subjects[ind+1],ind+1),'Next Page')]
+            task_htmls[-1].lines.append(add_link('sub-{}_{}.html'.format(subjects[ind+1],ind+1),'Next Page'))
 
 
         #Write out files
         with open(os.path.join(output_dir,broad_name),'w') as f:
-            f.writelines(broad_html)
+            f.write(''.join(broad_html))
 
         #Write out task files
         for t in task_htmls:
-            with open(os.path.join(output_dir,t[0]),'w') as f:
-                f.writelines(t[1])
+            with open(os.path.join(output_dir,t.name),'w') as f:
+                f.write(''.join(t.lines))
 
         #Store previous task htmls
         prev_task_htmls = task_htmls